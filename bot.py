@@ -1,18 +1,33 @@
 import os
+import re
+import math
+import time
 import logging
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import (
+    AIORateLimiter,
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     filters,
     ConversationHandler,
 )
-import requests
-from datetime import datetime
-import matplotlib.pyplot as plt
+import asyncio
+import threading
+import weakref
+import aiohttp
+import aiosqlite
+import orjson
+from dataclasses import dataclass
+from datetime import date, datetime
+from matplotlib import dates as mdates
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import numpy as np
 import io
-from deep_translator import GoogleTranslator
+from cachetools import LRUCache, TTLCache
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -24,11 +39,146 @@ logger = logging.getLogger(__name__)
 
 WEIGHT, HEIGHT, AGE, GENDER, ACTIVITY, CITY, FOOD_AMOUNT, WORKOUT_TYPE, WORKOUT_DURATION = range(9)
 
-users = {}
-
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN', 'TELEGRAM_TOKEN')
 WEATHER_API_KEY = os.getenv('WEATHER_API_KEY', 'WEATHER_API_KEY')
 NINJAS_API_KEY = os.getenv('NINJAS_API_KEY', 'NINJAS_API_KEY')
+DB_PATH = os.getenv('DB_PATH', 'bot.db')
+
+TRANSLATE_URL = 'https://translate.googleapis.com/translate_a/single'
+HISTORY_LIMIT = 500
+WATER_FLUSH_DELAY = 2
+MAX_WATER_ML = 5000
+BMR_GENDER_OFFSET = {'М': 5, 'Ж': -161}
+
+_WORKOUT_RE = re.compile(r'^(.+?)\s+(\d+)\s*$')
+
+GENDER_KB = ReplyKeyboardMarkup([['М', 'Ж']], one_time_keyboard=True)
+REMOVE_KB = ReplyKeyboardRemove()
+
+START_TEXT = (
+    "Доступные команды:\n"
+    "/set_profile - Настроить профиль\n"
+    "/log_water - Записать выпитую воду\n"
+    "/log_food - Записать съеденную еду\n"
+    "/log_workout - Записать тренировку\n"
+    "/check_progress - Проверить прогресс\n"
+    "/show_graphs - Показать графики прогресса\n"
+    "/help - Помощь"
+)
+HELP_TEXT = (
+    "/set_profile - Укажите вес, рост, возраст, пол, активность и город\n"
+    "/log_water <мл> - Например: /log_water 250\n"
+    "/log_food <название> - Например: /log_food банан\n"
+    "/log_workout <тип> <минуты> - Например: /log_workout бег 30\n"
+    "/check_progress - Посмотреть текущий прогресс\n"
+    "/show_graphs - Графики прогресса за день"
+)
+
+_translation_cache = LRUCache(maxsize=4096)
+_weather_cache = TTLCache(maxsize=512, ttl=600)
+_food_cache = TTLCache(maxsize=4096, ttl=24 * 60 * 60)
+
+
+class _ProfileCache(LRUCache):
+    def popitem(self):
+        user_id, cached = super().popitem()
+        user_data = telegram_app.user_data.get(user_id)
+        if user_data is not None:
+            user_data.pop('profile', None)
+            if not user_data:
+                telegram_app.drop_user_data(user_id)
+        return user_id, cached
+
+
+_profile_cache = _ProfileCache(maxsize=10_000)
+
+
+class _PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._locks = weakref.WeakValueDictionary()
+
+    async def process_update(self, update, coroutine):
+        owner = (update.effective_user or update.effective_chat) if isinstance(update, Update) else None
+        if owner is None:
+            async with self._semaphore:
+                await coroutine
+            return
+        lock = self._locks.get(owner.id)
+        if lock is None:
+            lock = self._locks[owner.id] = asyncio.Lock()
+        async with lock:
+            async with self._semaphore:
+                await coroutine
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+telegram_app = None
+app_session = None
+db = None
+_pending_water = {}
+_counters_day = None
+_counters_lock = asyncio.Lock()
+
+
+@dataclass(slots=True)
+class UserState:
+    user_id: int
+    weight: float | None = None
+    height: float | None = None
+    age: int | None = None
+    gender: str | None = None
+    activity: int | None = None
+    city: str | None = None
+    water_goal: int | None = None
+    calorie_goal: int | None = None
+    logged_water: int = 0
+    logged_calories: float = 0
+    burned_calories: float = 0
+
+
+HISTORY_DTYPE = np.dtype([('ts', 'int64'), ('amount', 'float64')])
+EMPTY_HISTORY = (np.empty(0, dtype='datetime64[s]'), np.empty(0))
+
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    weight REAL,
+    height REAL,
+    age INTEGER,
+    gender TEXT,
+    activity INTEGER,
+    city TEXT,
+    water_goal INTEGER,
+    calorie_goal INTEGER,
+    logged_water INTEGER NOT NULL DEFAULT 0,
+    logged_calories REAL NOT NULL DEFAULT 0,
+    burned_calories REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS history (
+    user_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    amount REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_user_kind_ts ON history (user_id, kind, ts);
+CREATE TABLE IF NOT EXISTS translations (
+    src TEXT PRIMARY KEY,
+    dst TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
 
 
 async def logging_middleware(update, context):
@@ -36,33 +186,60 @@ async def logging_middleware(update, context):
     
     if update.message:
         logger.info(
-            f"User {user.id} (@{user.username}) | "
-            f"Message: {update.message.text}"
+            "User %s (@%s) | Message: %s",
+            user.id, user.username, update.message.text
         )
     elif update.callback_query:
         logger.info(
-            f"User {user.id} (@{user.username}) | "
-            f"Callback: {update.callback_query.data}"
+            "User %s (@%s) | Callback: %s",
+            user.id, user.username, update.callback_query.data
         )
     
     return None
 
-def translate_to_english(text):
-    try:
-        translator = GoogleTranslator(source='auto', target='en')
-        translated = translator.translate(text)
+async def translate_to_english(text):
+    if text.isascii() and text.isprintable():
+        return text
+    
+    key = text.strip().lower()
+    translated = _translation_cache.get(key)
+    if translated is not None:
+        return translated
+    
+    async with db.execute('SELECT dst FROM translations WHERE src = ?', (key,)) as cursor:
+        row = await cursor.fetchone()
+    if row:
+        translated = _translation_cache[key] = row[0]
         return translated
+    
+    try:
+        params = {'client': 'gtx', 'sl': 'auto', 'tl': 'en', 'dt': 't', 'q': key}
+        async with app_session.get(TRANSLATE_URL, params=params, timeout=aiohttp.ClientTimeout(total=5)) as response:
+            response.raise_for_status()
+            data = orjson.loads(await response.read())
+        translated = ''.join(part[0] for part in data[0])
     except Exception as e:
         logger.error(f"Translation error: {e}")
         return text
+    
+    _translation_cache[key] = translated
+    await db.execute('INSERT OR REPLACE INTO translations (src, dst) VALUES (?, ?)', (key, translated))
+    return translated
 
-def get_weather(city):
+async def get_weather(city):
+    key = city.strip().lower()
+    temperature = _weather_cache.get(key)
+    if temperature is not None:
+        return temperature
+    
     try:
         url = f"http://api.openweathermap.org/data/2.5/weather?q={city}&appid={WEATHER_API_KEY}&units=metric"
-        response = requests.get(url, timeout=5)
-        if response.status_code == 200:
-            data = response.json()
-            return data['main']['temp']
+        async with app_session.get(url, timeout=aiohttp.ClientTimeout(total=5)) as response:
+            if response.status == 200:
+                data = orjson.loads(await response.read())
+                temperature = data['main']['temp']
+                _weather_cache[key] = temperature
+                return temperature
         return None
     except Exception as e:
         logger.error(f"Weather API error: {e}")
@@ -76,104 +253,167 @@ def calculate_water_goal(weight, activity_minutes, temperature):
         temp_bonus = 750
     elif temperature and temperature > 20:
         temp_bonus = 500
-    return base + activity_bonus + temp_bonus
+    return round(base + activity_bonus + temp_bonus)
 
 def calculate_calorie_goal(weight, height, age, gender, activity_minutes):
-    if gender == 'М':
-        bmr = 10 * weight + 6.25 * height - 5 * age + 5
-    else:
-        bmr = 10 * weight + 6.25 * height - 5 * age - 161
-    
+    bmr = 10 * weight + 6.25 * height - 5 * age + BMR_GENDER_OFFSET[gender]
     activity_bonus = (activity_minutes / 30) * 250
     return int(bmr + activity_bonus)
 
-def get_calories_burned(activity, duration_minutes, weight):
+def _workout_calories_kernel(calories_per_hour, weight, duration_minutes):
+    return int(calories_per_hour / 60 * (weight / 70) * duration_minutes)
+
+async def get_calories_burned(activity, duration_minutes, weight):
     try:
-        activity_en = translate_to_english(activity)
+        activity_en = await translate_to_english(activity)
         url = f"https://api.api-ninjas.com/v1/caloriesburned?activity={activity_en}"
         headers = {'X-Api-Key': NINJAS_API_KEY}
-        response = requests.get(url, headers=headers, timeout=20)
-        
-        if response.status_code == 200:
-            data = response.json()
-            if data and len(data) > 0:
-                calories_per_minute = data[0]['calories_per_hour'] / 60
-                adjusted_calories = calories_per_minute * (weight / 70)
-                return int(adjusted_calories * duration_minutes)
+        async with app_session.get(url, headers=headers) as response:
+            if response.status == 200:
+                data = orjson.loads(await response.read())
+                if data and len(data) > 0:
+                    return _workout_calories_kernel(data[0]['calories_per_hour'], weight, duration_minutes)
         return int(duration_minutes * 5 * (weight / 70))
     except Exception as e:
         logger.error(f"Calories burned API error: {e}")
         return int(duration_minutes * 5 * (weight / 70))
 
-def get_food_calories(food_name):
+async def get_food_calories(food_name):
+    key = food_name.strip().lower()
+    food_data = _food_cache.get(key)
+    if food_data is not None:
+        return food_data
+    
     try:
-        food_en = translate_to_english(food_name)
-        url = f"https://world.openfoodfacts.org/cgi/search.pl?search_terms={food_en}&json=true"
-        response = requests.get(url, timeout=600)
-        
-        if response.status_code == 200:
-            data = response.json()
-            if data['products']:
-                product = data['products'][0]
-                calories = product.get('nutriments', {}).get('energy-kcal_100g', 0)
-                return {
-                    'name': product.get('product_name', food_name),
-                    'calories': calories,
-                    'serving_size': 100
-                }
+        food_en = await translate_to_english(food_name)
+        url = f"https://world.openfoodfacts.org/cgi/search.pl?search_terms={food_en}&json=true&page_size=1&fields=product_name,nutriments"
+        async with app_session.get(url, timeout=aiohttp.ClientTimeout(total=8)) as response:
+            if response.status == 200:
+                data = orjson.loads(await response.read())
+                if data['products']:
+                    product = data['products'][0]
+                    calories = product.get('nutriments', {}).get('energy-kcal_100g', 0)
+                    food_data = _food_cache[key] = {
+                        'name': product.get('product_name', food_name),
+                        'calories': calories,
+                        'serving_size': 100
+                    }
+                    return food_data
     except Exception as e:
         logger.error(f"OpenFoodFacts API error: {e}")
     
     return None
 
-def init_user_data(user_id):
-    if user_id not in users:
-        users[user_id] = {
-            'weight': None,
-            'height': None,
-            'age': None,
-            'gender': None,
-            'activity': None,
-            'city': None,
-            'water_goal': None,
-            'calorie_goal': None,
-            'logged_water': 0,
-            'logged_calories': 0,
-            'burned_calories': 0,
-            'water_history': [],
-            'calorie_history': [],
-            'temp_food_data': None
-        }
-
-async def start(update, context):
+async def load_user(user_id):
+    pending = _pending_water.get(user_id)
+    async with db.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)) as cursor:
+        row = await cursor.fetchone()
+    if row:
+        user_data = UserState(**row)
+        if pending:
+            user_data.logged_water += pending[0]
+        return user_data
+    return UserState(user_id)
+
+async def get_user(update, context):
+    if _counters_day != date.today().isoformat():
+        await roll_over_day()
     user_id = update.effective_user.id
-    init_user_data(user_id)
-    
-    await update.message.reply_text(
-        "Доступные команды:\n"
-        "/set_profile - Настроить профиль\n"
-        "/log_water - Записать выпитую воду\n"
-        "/log_food - Записать съеденную еду\n"
-        "/log_workout - Записать тренировку\n"
-        "/check_progress - Проверить прогресс\n"
-        "/show_graphs - Показать графики прогресса\n"
-        "/help - Помощь"
+    _profile_cache[user_id] = True
+    user_data = context.user_data.get('profile')
+    if user_data is None:
+        user_data = context.user_data.setdefault('profile', await load_user(user_id))
+    return user_data
+
+async def update_user(user_data, **fields):
+    columns = ', '.join(fields)
+    placeholders = ', '.join('?' * len(fields))
+    assignments = ', '.join(f'{column} = excluded.{column}' for column in fields)
+    await db.execute(
+        f'INSERT INTO users (user_id, {columns}) VALUES (?, {placeholders}) '
+        f'ON CONFLICT(user_id) DO UPDATE SET {assignments}',
+        (user_data.user_id, *fields.values())
     )
+    for column, value in fields.items():
+        setattr(user_data, column, value)
 
-async def help_command(update, context):
-    await update.message.reply_text(
-        "/set_profile - Укажите вес, рост, возраст, пол, активность и город\n"
-        "/log_water <мл> - Например: /log_water 250\n"
-        "/log_food <название> - Например: /log_food банан\n"
-        "/log_workout <тип> <минуты> - Например: /log_workout бег 30\n"
-        "/check_progress - Посмотреть текущий прогресс\n"
-        "/show_graphs - Графики прогресса за день"
+async def add_history(user_id, kind, ts, amount):
+    await db.execute(
+        'INSERT INTO history (user_id, kind, ts, amount) VALUES (?, ?, ?, ?)',
+        (user_id, kind, ts, amount)
     )
 
+async def load_today_history(user_id, kind):
+    async with db.execute(
+        "SELECT ts, amount FROM ("
+        "SELECT rowid, ts, amount FROM history WHERE user_id = ? AND kind = ? "
+        "AND ts >= CAST(strftime('%s', 'now', 'localtime', 'start of day', 'utc') AS INTEGER) "
+        "ORDER BY ts DESC, rowid DESC LIMIT ?"
+        ") ORDER BY ts, rowid",
+        (user_id, kind, HISTORY_LIMIT)
+    ) as cursor:
+        cursor.row_factory = None
+        rows = await cursor.fetchall()
+    history = np.fromiter(rows, dtype=HISTORY_DTYPE, count=len(rows))
+    utc_offset = int(datetime.now().astimezone().utcoffset().total_seconds())
+    times = (history['ts'] + utc_offset).astype('datetime64[s]')
+    return times, history['amount']
+
+async def flush_water(user_id):
+    pending = _pending_water.pop(user_id, None)
+    if pending is None:
+        return
+    amount, ts = pending
+    try:
+        async with db.execute(
+            'UPDATE users SET logged_water = logged_water + ? WHERE user_id = ? RETURNING logged_water',
+            (amount, user_id)
+        ) as cursor:
+            row = await cursor.fetchone()
+    except Exception as e:
+        logger.error(f"Water flush error: {e}")
+        current = _pending_water.get(user_id)
+        if current:
+            _pending_water[user_id] = (current[0] + amount, ts)
+        else:
+            _pending_water[user_id] = (amount, ts)
+            telegram_app.job_queue.run_once(flush_water_job, WATER_FLUSH_DELAY, data=user_id)
+        return
+    if row:
+        await add_history(user_id, 'water', ts, row[0])
+    await db.commit()
+
+async def flush_water_job(context):
+    await flush_water(context.job.data)
+
+async def roll_over_day():
+    global _counters_day
+    async with _counters_lock:
+        today = date.today().isoformat()
+        if _counters_day == today:
+            return
+        for user_id in list(_pending_water):
+            await flush_water(user_id)
+        await db.execute('UPDATE users SET logged_water = 0, logged_calories = 0, burned_calories = 0')
+        await db.execute(
+            "DELETE FROM history "
+            "WHERE ts < CAST(strftime('%s', 'now', 'localtime', 'start of day', 'utc') AS INTEGER)"
+        )
+        await db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('counters_day', ?)", (today,))
+        await db.commit()
+        _counters_day = today
+        for user_data in telegram_app.user_data.values():
+            profile = user_data.get('profile')
+            if profile:
+                profile.logged_water = profile.logged_calories = profile.burned_calories = 0
+
+async def start(update, context):
+    await update.message.reply_text(START_TEXT)
+
+async def help_command(update, context):
+    await update.message.reply_text(HELP_TEXT)
+
 async def set_profile(update, context):
-    user_id = update.effective_user.id
-    init_user_data(user_id)
-    
     await update.message.reply_text(
         "Настройка профиля\n\n"
         "Введите ваш вес (в кг):"
@@ -181,10 +421,13 @@ async def set_profile(update, context):
     return WEIGHT
 
 async def weight_handler(update, context):
-    user_id = update.effective_user.id
+    user_data = await get_user(update, context)
     try:
         weight = float(update.message.text)
-        users[user_id]['weight'] = weight
+        if not math.isfinite(weight):
+            raise ValueError
+        await update_user(user_data, weight=weight)
+        await db.commit()
         await update.message.reply_text("Введите ваш рост (в см):")
         return HEIGHT
     except ValueError:
@@ -192,10 +435,13 @@ async def weight_handler(update, context):
         return WEIGHT
 
 async def height_handler(update, context):
-    user_id = update.effective_user.id
+    user_data = await get_user(update, context)
     try:
         height = float(update.message.text)
-        users[user_id]['height'] = height
+        if not math.isfinite(height):
+            raise ValueError
+        await update_user(user_data, height=height)
+        await db.commit()
         await update.message.reply_text("Введите ваш возраст:")
         return AGE
     except ValueError:
@@ -203,13 +449,14 @@ async def height_handler(update, context):
         return HEIGHT
 
 async def age_handler(update, context):
-    user_id = update.effective_user.id
+    user_data = await get_user(update, context)
     try:
         age = int(update.message.text)
-        users[user_id]['age'] = age
+        await update_user(user_data, age=age)
+        await db.commit()
         await update.message.reply_text(
             "Укажите ваш пол:",
-            reply_markup=ReplyKeyboardMarkup([['М', 'Ж']], one_time_keyboard=True)
+            reply_markup=GENDER_KB
         )
         return GENDER
     except ValueError:
@@ -217,25 +464,27 @@ async def age_handler(update, context):
         return AGE
 
 async def gender_handler(update, context):
-    user_id = update.effective_user.id
+    user_data = await get_user(update, context)
     gender = update.message.text
     
     if gender not in ['М', 'Ж']:
         await update.message.reply_text("Пожалуйста, выберите М или Ж:")
         return GENDER
     
-    users[user_id]['gender'] = gender
+    await update_user(user_data, gender=gender)
+    await db.commit()
     await update.message.reply_text(
         "Цель активности в день (в минутах):",
-        reply_markup=ReplyKeyboardRemove()
+        reply_markup=REMOVE_KB
     )
     return ACTIVITY
 
 async def activity_handler(update, context):
-    user_id = update.effective_user.id
+    user_data = await get_user(update, context)
     try:
         activity = int(update.message.text)
-        users[user_id]['activity'] = activity
+        await update_user(user_data, activity=activity)
+        await db.commit()
         await update.message.reply_text("В каком городе вы находитесь?")
         return CITY
     except ValueError:
@@ -243,101 +492,108 @@ async def activity_handler(update, context):
         return ACTIVITY
 
 async def city_handler(update, context):
-    user_id = update.effective_user.id
+    await flush_water(update.effective_user.id)
+    user_data = await get_user(update, context)
     city = update.message.text
-    users[user_id]['city'] = city
     
-    temperature = get_weather(city)
+    temperature = await get_weather(city)
     temp_text = f"{temperature}°C" if temperature else "не определена"
     
-    user_data = users[user_id]
     water_goal = calculate_water_goal(
-        user_data['weight'],
-        user_data['activity'],
+        user_data.weight,
+        user_data.activity,
         temperature
     )
     calorie_goal = calculate_calorie_goal(
-        user_data['weight'],
-        user_data['height'],
-        user_data['age'],
-        user_data['gender'],
-        user_data['activity']
+        user_data.weight,
+        user_data.height,
+        user_data.age,
+        user_data.gender,
+        user_data.activity
     )
     
-    users[user_id]['water_goal'] = water_goal
-    users[user_id]['calorie_goal'] = calorie_goal
-    users[user_id]['logged_water'] = 0
-    users[user_id]['logged_calories'] = 0
-    users[user_id]['burned_calories'] = 0
+    await update_user(
+        user_data,
+        city=city,
+        water_goal=water_goal,
+        calorie_goal=calorie_goal,
+        logged_water=0,
+        logged_calories=0,
+        burned_calories=0
+    )
+    await db.commit()
     
     
     await update.message.reply_text(
         f"Ваши параметры:\n"
-        f"Вес: {user_data['weight']} кг\n"
-        f"Рост: {user_data['height']} см\n"
-        f"Возраст: {user_data['age']} лет\n"
-        f"Пол: {user_data['gender']}\n"
-        f"Активность: {user_data['activity']} мин/день\n"
+        f"Вес: {user_data.weight} кг\n"
+        f"Рост: {user_data.height} см\n"
+        f"Возраст: {user_data.age} лет\n"
+        f"Пол: {user_data.gender}\n"
+        f"Активность: {user_data.activity} мин/день\n"
         f"Город: {city}\n"
         f"Температура: {temp_text}\n\n"
         f"Норма воды: {water_goal} мл\n"
-        f"Норма калорий: {calorie_goal} ккал"
+        f"Норма калорий: {calorie_goal} ккал",
+        parse_mode=None
     )
     return ConversationHandler.END
 
 async def cancel(update, context):
+    context.user_data.pop('temp_food_data', None)
     await update.message.reply_text(
         "Настройка отменена.",
-        reply_markup=ReplyKeyboardRemove()
+        reply_markup=REMOVE_KB
     )
     return ConversationHandler.END
 
 async def log_water(update, context):
+    now = int(time.time())
     user_id = update.effective_user.id
-    init_user_data(user_id)
+    user_data = await get_user(update, context)
     
-    if not users[user_id]['water_goal']:
+    if not user_data.water_goal:
         await update.message.reply_text(
             "Сначала настройте профиль командой /set_profile"
         )
         return
     
-    try:
-        amount = int(context.args[0]) if context.args else 0
-        if amount <= 0:
-            raise ValueError
-        
-        users[user_id]['logged_water'] += amount
-        remaining = users[user_id]['water_goal'] - users[user_id]['logged_water']
-        
-        users[user_id]['water_history'].append({
-            'time': datetime.now(),
-            'amount': users[user_id]['logged_water']
-        })
-        
-        
-        if remaining <= 0:
-            await update.message.reply_text(
-                f"Записано: {amount} мл\n"
-                f"Вы выполнили дневную норму воды"
-            )
-        else:
-            await update.message.reply_text(
-                f"Записано: {amount} мл\n"
-                f"Выпито: {users[user_id]['logged_water']} мл из {users[user_id]['water_goal']} мл\n"
-                f"Осталось: {remaining} мл"
-            )
-    except (IndexError, ValueError):
+    arg = context.args[0] if context.args else ''
+    amount = int(arg) if arg.isdecimal() else 0
+    if not 0 < amount <= MAX_WATER_ML:
         await update.message.reply_text(
-            "Используйте: /log_water <количество в мл>\n"
+            f"Используйте: /log_water <количество в мл, до {MAX_WATER_ML}>\n"
             "Например: /log_water 250"
         )
+        return
+    
+    water_goal = user_data.water_goal
+    logged_water = user_data.logged_water = user_data.logged_water + amount
+    remaining = water_goal - logged_water
+    
+    pending = _pending_water.get(user_id)
+    if pending is None:
+        _pending_water[user_id] = (amount, now)
+        context.application.job_queue.run_once(flush_water_job, WATER_FLUSH_DELAY, data=user_id)
+    else:
+        _pending_water[user_id] = (pending[0] + amount, pending[1])
+    
+    if remaining <= 0:
+        await update.message.reply_text(
+            f"Записано: {amount} мл\n"
+            f"Вы выполнили дневную норму воды"
+        )
+    else:
+        await update.message.reply_text(
+            f"Записано: {amount} мл\n"
+            f"Выпито: {logged_water} мл из {water_goal} мл\n"
+            f"Осталось: {remaining} мл"
+        )
 
 async def log_food_start(update, context):
-    user_id = update.effective_user.id
-    init_user_data(user_id)
+    user_data = await get_user(update, context)
     
-    if not users[user_id]['calorie_goal']:
+    if not user_data.calorie_goal:
         await update.message.reply_text(
             "Сначала настройте профиль командой /set_profile"
         )
@@ -351,53 +607,61 @@ async def log_food_start(update, context):
         return ConversationHandler.END
     
     food_name = ' '.join(context.args)
-    await update.message.reply_text(f"Ищу информацию о '{food_name}'...")
-    
-    food_data = get_food_calories(food_name)
+    _, food_data = await asyncio.gather(
+        update.message.reply_text(f"Ищу информацию о '{food_name}'...", parse_mode=None),
+        get_food_calories(food_name)
+    )
     
     if not food_data:
         await update.message.reply_text(
             f"Не удалось найти информацию о '{food_name}'. "
-            f"Попробуйте другое название."
+            f"Попробуйте другое название.",
+            parse_mode=None
         )
         return ConversationHandler.END
     
-    users[user_id]['temp_food_data'] = food_data
+    context.user_data['temp_food_data'] = food_data
     
     await update.message.reply_text(
         f"{food_data['name'].capitalize()}\n"
         f"Калории: {food_data['calories']} ккал на {food_data['serving_size']} г\n\n"
-        f"Сколько грамм вы съели?"
+        f"Сколько грамм вы съели?",
+        parse_mode=None
     )
     
     return FOOD_AMOUNT
 
 async def food_amount_handler(update, context):
+    now = int(time.time())
     user_id = update.effective_user.id
     
     try:
         amount = float(update.message.text)
-        if amount <= 0:
+        if not math.isfinite(amount) or amount <= 0:
             raise ValueError
         
-        food_data = users[user_id]['temp_food_data']
+        food_data = context.user_data.get('temp_food_data')
+        if not food_data:
+            await update.message.reply_text(
+                "Данные о продукте потеряны. Начните заново: /log_food <название продукта>"
+            )
+            return ConversationHandler.END
         calories = (food_data['calories'] / food_data['serving_size']) * amount
         
-        users[user_id]['logged_calories'] += calories
-        
-        users[user_id]['calorie_history'].append({
-            'time': datetime.now(),
-            'amount': users[user_id]['logged_calories']
-        })
+        user_data = await get_user(update, context)
+        logged_calories = user_data.logged_calories + calories
         
+        await update_user(user_data, logged_calories=logged_calories)
+        await add_history(user_id, 'calories', now, logged_calories - user_data.burned_calories)
+        await db.commit()
 
         await update.message.reply_text(
             f"Записано: {calories:.1f} ккал\n"
-            f"Потреблено: {users[user_id]['logged_calories']:.1f} ккал\n"
-            f"Осталось до цели: {users[user_id]['calorie_goal'] - users[user_id]['logged_calories'] + users[user_id]['burned_calories']:.1f} ккал"
+            f"Потреблено: {logged_calories:.1f} ккал\n"
+            f"Осталось до цели: {user_data.calorie_goal - logged_calories + user_data.burned_calories:.1f} ккал"
         )
         
-        users[user_id]['temp_food_data'] = None
+        context.user_data.pop('temp_food_data', None)
         return ConversationHandler.END
         
     except ValueError:
@@ -405,211 +669,275 @@ async def food_amount_handler(update, context):
         return FOOD_AMOUNT
 
 async def log_workout_start(update, context):
+    now = int(time.time())
     user_id = update.effective_user.id
-    init_user_data(user_id)
+    user_data = await get_user(update, context)
     
-    if not users[user_id]['calorie_goal']:
+    if not user_data.calorie_goal:
         await update.message.reply_text(
             "Сначала настройте профиль командой /set_profile"
         )
         return ConversationHandler.END
     
-    if len(context.args) < 2:
+    match = _WORKOUT_RE.match(' '.join(context.args))
+    duration = int(match.group(2)) if match else 0
+    if duration <= 0:
         await update.message.reply_text(
             "Используйте: /log_workout <тип тренировки> <минуты>\n"
             "Например: /log_workout бег 30"
         )
         return ConversationHandler.END
     
-    try:
-        duration = int(context.args[-1])
-        workout_type = ' '.join(context.args[:-1])
-        
-        if duration <= 0:
-            raise ValueError
-        
-        weight = users[user_id]['weight']
-        calories_burned = get_calories_burned(workout_type, duration, weight)
-        
-        users[user_id]['burned_calories'] += calories_burned
-
-        users[user_id]['calorie_history'].append({
-            'time': datetime.now(),
-            'amount': -users[user_id]['burned_calories']
-        })
+    workout_type = match.group(1)
+    
+    calories_burned = await get_calories_burned(workout_type, duration, user_data.weight)
+    burned_calories = user_data.burned_calories + calories_burned
 
-        users[user_id]['water_history'].append({
-            'time': datetime.now(),
-            'amount': (duration // 30) * -200
-        })
-        
-        
-        
-        await update.message.reply_text(
-            f"{workout_type.capitalize()} {duration} минут\n"
-            f"Сожжено: {calories_burned} ккал\n"
-            f"Дополнительно выпейте: {(duration // 30) * 200} мл воды\n\n"
-            f"Можно съесть ещё: {users[user_id]['calorie_goal'] - users[user_id]['logged_calories'] + users[user_id]['burned_calories']:.1f} ккал"
-        )
-        
-        return ConversationHandler.END
-        
-    except (ValueError, IndexError):
-        await update.message.reply_text(
-            "Используйте: /log_workout <тип тренировки> <минуты>\n"
-            "Например: /log_workout бег 30"
-        )
-        return ConversationHandler.END
+    await update_user(user_data, burned_calories=burned_calories)
+    await add_history(user_id, 'calories', now, user_data.logged_calories - burned_calories)
+    await add_history(user_id, 'water', now, (duration // 30) * -200)
+    await db.commit()
+    
+    await update.message.reply_text(
+        f"{workout_type.capitalize()} {duration} минут\n"
+        f"Сожжено: {calories_burned} ккал\n"
+        f"Дополнительно выпейте: {(duration // 30) * 200} мл воды\n\n"
+        f"Можно съесть ещё: {user_data.calorie_goal - user_data.logged_calories + burned_calories:.1f} ккал",
+        parse_mode=None
+    )
+    
+    return ConversationHandler.END
 
 async def check_progress(update, context):
-    user_id = update.effective_user.id
-    init_user_data(user_id)
+    user_data = await get_user(update, context)
     
-    if not users[user_id]['water_goal']:
+    if not user_data.water_goal:
         await update.message.reply_text(
             "Сначала настройте профиль командой /set_profile"
         )
         return
     
-    user_data = users[user_id]
-    water_remaining = user_data['water_goal'] - user_data['logged_water']
-    calorie_balance = user_data['logged_calories'] - user_data['burned_calories']
-    calorie_remaining = user_data['calorie_goal'] - calorie_balance
-    
+    water_goal = user_data.water_goal
+    logged_water = user_data.logged_water
+    logged_calories = user_data.logged_calories
+    burned_calories = user_data.burned_calories
     
+    water_remaining = water_goal - logged_water
+    calorie_balance = logged_calories - burned_calories
+    calorie_remaining = user_data.calorie_goal - calorie_balance
     
     await update.message.reply_text(
         f"Прогресс:\n\n"
         f"Вода:\n"
-        f"- Выпито: {user_data['logged_water']} мл из {user_data['water_goal']} мл\n"
+        f"- Выпито: {logged_water} мл из {water_goal} мл\n"
         f"- Осталось: {max(0, water_remaining)} мл\n\n"
         f"Калории:\n"
-        f"- Потреблено: {user_data['logged_calories']:.1f} ккал\n"
-        f"- Сожжено: {user_data['burned_calories']:.1f} ккал\n"
+        f"- Потреблено: {logged_calories:.1f} ккал\n"
+        f"- Сожжено: {burned_calories:.1f} ккал\n"
         f"- Баланс: {calorie_balance:.1f} ккал\n"
         f"- Осталось до цели: {calorie_remaining:.1f} ккал"
     )
 
+def _build_panel(ax, title, ylabel, line_label, color, placeholder):
+    ax.set_title(title, fontsize=15, fontweight='bold', pad=15)
+    ax.set_ylabel(ylabel, fontsize=13, fontweight='bold')
+    ax.grid(True, alpha=0.3, linestyle='--')
+    ax.xaxis_date()
+    
+    line, = ax.plot([], [], marker='o', linewidth=2.5, markersize=8,
+                    color=color, label=line_label, zorder=3)
+    goal = ax.axhline(y=0, color='#2ecc71', linestyle='--',
+                      linewidth=2, label='Цель', zorder=2)
+    legend = ax.legend(handles=[line, goal], fontsize=11, loc='upper right')
+    stats = ax.text(0.02, 0.98, '',
+                    transform=ax.transAxes,
+                    fontsize=11,
+                    verticalalignment='top',
+                    bbox=dict(boxstyle='round', facecolor='wheat', alpha=0.8))
+    empty = ax.text(0.5, 0.5, placeholder, ha='center', va='center',
+                    transform=ax.transAxes, fontsize=14)
+    
+    return {
+        'ax': ax,
+        'line': line,
+        'goal': goal,
+        'legend': legend,
+        'stats': stats,
+        'empty': empty,
+        'fill': None
+    }
+
+def _toggle_panel(panel, has_data):
+    if panel['fill'] is not None:
+        panel['fill'].remove()
+        panel['fill'] = None
+    
+    if has_data:
+        panel['ax'].set_axis_on()
+    else:
+        panel['ax'].set_axis_off()
+    for artist in (panel['line'], panel['goal'], panel['legend'], panel['stats']):
+        artist.set_visible(has_data)
+    panel['empty'].set_visible(not has_data)
+
+def _fill_panel(panel, times, amounts, goal, goal_label, stats_text):
+    _toggle_panel(panel, True)
+    ax = panel['ax']
+    x = mdates.date2num(times)
+    
+    panel['line'].set_data(x, amounts)
+    panel['goal'].set_ydata([goal, goal])
+    panel['legend'].get_texts()[1].set_text(goal_label)
+    panel['stats'].set_text(stats_text)
+    
+    ax.relim()
+    panel['fill'] = ax.fill_between(x, amounts, alpha=0.2, color=panel['line'].get_color())
+    ax.autoscale_view()
+
+_FIG = Figure(figsize=(12, 10), dpi=96)
+_CANVAS = FigureCanvasAgg(_FIG)
+_FIG_LOCK = threading.Lock()
+_AX1, _AX2 = _FIG.subplots(2, 1)
+_FIG.subplots_adjust(left=0.08, right=0.97, bottom=0.06, top=0.95, hspace=0.2)
+_WATER_PANEL = _build_panel(_AX1, 'Прогресс по воде', 'Вода (мл)', 'Выпито воды',
+                            '#3498db', 'Нет данных о воде')
+_CALORIE_PANEL = _build_panel(_AX2, 'Прогресс по калориям', 'Калории (ккал)', 'Чистый баланс',
+                              '#9b59b6', 'Нет данных о калориях')
+_AX2.set_xlabel('Время', fontsize=13, fontweight='bold')
+
+def render_graphs(user_data, water, calories):
+    water_times, water_amounts = water
+    calorie_times, net_calories = calories
+    with _FIG_LOCK:
+        if water_times.size:
+            water_goal = user_data.water_goal
+            current_water = user_data.logged_water
+            _fill_panel(
+                _WATER_PANEL, water_times, water_amounts, water_goal,
+                f"Цель: {water_goal} мл",
+                f"Текущий объём: {current_water} мл ({(current_water / water_goal) * 100:.1f}%)\n"
+                f"Осталось: {max(0, water_goal - current_water)} мл"
+            )
+        else:
+            _toggle_panel(_WATER_PANEL, False)
+        
+        if calorie_times.size:
+            calorie_goal = user_data.calorie_goal
+            logged_calories = user_data.logged_calories
+            burned = user_data.burned_calories
+            current_net = logged_calories - burned
+            _fill_panel(
+                _CALORIE_PANEL, calorie_times, net_calories, calorie_goal,
+                f"Цель: {calorie_goal} ккал",
+                f"Потреблено: {logged_calories:.0f} ккал\n"
+                f'Сожжено: {burned:.0f} ккал\n'
+                f"Баланс: {current_net:.0f} ккал ({(current_net / calorie_goal) * 100:.1f}%)\n"
+                f"Осталось: {calorie_goal - current_net:.0f} ккал"
+            )
+        else:
+            _toggle_panel(_CALORIE_PANEL, False)
+
+        buf = io.BytesIO()
+        _CANVAS.print_png(buf)
+        return buf.getvalue()
+
 async def show_graphs(update, context):
     user_id = update.effective_user.id
-    init_user_data(user_id)
+    user_data = await get_user(update, context)
     
-    if not users[user_id]['water_goal']:
+    if not user_data.water_goal:
         await update.message.reply_text(
             "Сначала настройте профиль командой /set_profile"
         )
         return
     
-    user_data = users[user_id]
+    await flush_water(user_id)
+    water_times, water_amounts = await load_today_history(user_id, 'water')
+    calorie_times, net_calories = await load_today_history(user_id, 'calories')
     
-    if not user_data['water_history'] and not user_data['calorie_history']:
+    if not water_times.size and not calorie_times.size:
         await update.message.reply_text(
             "Пока нет данных для графиков. Начните логировать воду и еду!"
         )
         return
     
-    fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(12, 10))
-    
-    if user_data['water_history']:
-        times = [entry['time'] for entry in user_data['water_history']]
-        amounts = [entry['amount'] for entry in user_data['water_history']]
-        
-        ax1.plot(times, amounts, marker='o', linewidth=2.5, markersize=8, 
-                 color='#3498db', label='Выпито воды')
-        ax1.axhline(y=user_data['water_goal'], color='#2ecc71', linestyle='--', 
-                    linewidth=2, label=f"Цель: {user_data['water_goal']} мл")
-        ax1.fill_between(times, amounts, alpha=0.2, color='#3498db')
-        
-        current_water = user_data['logged_water']
-        
-        ax1.text(0.02, 0.98, 
-                 f"Текущий объём: {current_water} мл ({(current_water / user_data['water_goal']) * 100:.1f}%)\n"
-                 f"Осталось: {max(0, user_data['water_goal'] - current_water)} мл",
-                 transform=ax1.transAxes,
-                 fontsize=11,
-                 verticalalignment='top',
-                 bbox=dict(boxstyle='round', facecolor='wheat', alpha=0.8))
-        
-        ax1.set_ylabel('Вода (мл)', fontsize=13, fontweight='bold')
-        ax1.set_title('Прогресс по воде', fontsize=15, fontweight='bold', pad=15)
-        ax1.legend(fontsize=11, loc='upper right')
-        ax1.grid(True, alpha=0.3, linestyle='--')
-    else:
-        ax1.text(0.5, 0.5, 'Нет данных о воде', ha='center', va='center', 
-                 transform=ax1.transAxes, fontsize=14)
-        ax1.set_title('Прогресс по воде', fontsize=15, fontweight='bold', pad=15)
-    
-    if user_data['calorie_history']:
-        times = [entry['time'] for entry in user_data['calorie_history']]
-        consumed = [entry['amount'] for entry in user_data['calorie_history']]
-        
-        ax2.plot(times, consumed, marker='s', linewidth=2.5, markersize=8, 
-                 color='#e74c3c', label='Потреблено', zorder=3)
-        ax2.fill_between(times, consumed, alpha=0.2, color='#e74c3c')
-        
-        burned = user_data['burned_calories']
-        net_calories = [c - burned for c in consumed]
-        ax2.plot(times, net_calories, marker='o', linewidth=2.5, markersize=8,
-                 color='#9b59b6', label='Чистый баланс', linestyle='--', zorder=3)
-        
-        ax2.axhline(y=user_data['calorie_goal'], color='#2ecc71', linestyle='--',
-                    linewidth=2, label=f"Цель: {user_data['calorie_goal']} ккал", zorder=2)
-        
-        if burned > 0:
-            ax2.fill_between(times, consumed, net_calories, 
-                            alpha=0.3, color='#f39c12', 
-                            label=f'Сожжено: {burned:.0f} ккал')
-        
-        current_net = user_data['logged_calories'] - burned
-        
-        stats_text = (
-            f"Потреблено: {user_data['logged_calories']:.0f} ккал\n"
-            f'Сожжено: {burned:.0f} ккал\n'
-            f"Баланс: {current_net:.0f} ккал ({(current_net / user_data['calorie_goal']) * 100:.1f}%)\n"
-            f"Осталось: {user_data['calorie_goal'] - current_net:.0f} ккал"
-        )
-        
-        ax2.text(0.02, 0.98, stats_text,
-                 transform=ax2.transAxes,
-                 fontsize=11,
-                 verticalalignment='top',
-                 bbox=dict(boxstyle='round', facecolor='wheat', alpha=0.8))
-        
-        ax2.set_ylabel('Калории (ккал)', fontsize=13, fontweight='bold')
-        ax2.set_xlabel('Время', fontsize=13, fontweight='bold')
-        ax2.set_title('Прогресс по калориям', fontsize=15, fontweight='bold', pad=15)
-        ax2.legend(fontsize=11, loc='upper right')
-        ax2.grid(True, alpha=0.3, linestyle='--')
-    else:
-        ax2.text(0.5, 0.5, 'Нет данных о калориях', ha='center', va='center',
-                 transform=ax2.transAxes, fontsize=14)
-        ax2.set_title('Прогресс по калориям', fontsize=15, fontweight='bold', pad=15)
-    
-    plt.tight_layout()
-    
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=120, bbox_inches='tight')
-    buf.seek(0)
-    plt.close()
+    png = await asyncio.to_thread(
+        render_graphs, user_data, (water_times, water_amounts), (calorie_times, net_calories)
+    )
     
     caption = "Ваш прогресс за сегодня\n\n"
     
-    if user_data['water_history']:
-        caption += f"Вода: {(user_data['logged_water'] / user_data['water_goal']) * 100:.0f}% выполнено\n"
+    if water_times.size:
+        caption += f"Вода: {(user_data.logged_water / user_data.water_goal) * 100:.0f}% выполнено\n"
     
-    if user_data['calorie_history']:
-        caption += f"Калории: {((user_data['logged_calories'] - user_data['burned_calories']) / user_data['calorie_goal']) * 100:.0f}% от цели"
+    if calorie_times.size:
+        caption += f"Калории: {((user_data.logged_calories - user_data.burned_calories) / user_data.calorie_goal) * 100:.0f}% от цели"
     
     await update.message.reply_photo(
-        photo=buf,
+        photo=png,
         caption=caption
     )
 
+async def post_init(application):
+    global telegram_app, app_session, db, _counters_day
+    telegram_app = application
+    app_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=64, ttl_dns_cache=300),
+        timeout=aiohttp.ClientTimeout(total=10)
+    )
+    db = await aiosqlite.connect(DB_PATH)
+    db.row_factory = aiosqlite.Row
+    await db.execute('PRAGMA journal_mode=WAL')
+    await db.execute('PRAGMA synchronous=NORMAL')
+    await db.executescript(DB_SCHEMA)
+    async with db.execute("SELECT value FROM meta WHERE key = 'counters_day'") as cursor:
+        row = await cursor.fetchone()
+    _counters_day = row[0] if row else None
+    await roll_over_day()
+    render_graphs(None, EMPTY_HISTORY, EMPTY_HISTORY)
+
+async def post_shutdown(application):
+    for user_id in list(_pending_water):
+        await flush_water(user_id)
+    await db.commit()
+    await app_session.close()
+    await db.close()
+
+COMMANDS = {
+    'start': start,
+    'help': help_command,
+    'log_water': log_water,
+    'log_workout': log_workout_start,
+    'check_progress': check_progress,
+    'show_graphs': show_graphs,
+}
+
+async def dispatch_command(update, context):
+    command, *args = update.message.text.split()
+    name, _, bot_username = command[1:].partition('@')
+    if bot_username and bot_username.lower() != context.bot.username.lower():
+        return
+    
+    callback = COMMANDS.get(name.lower())
+    if callback:
+        context.args = args
+        await callback(update, context)
+
 def main():
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(_PerUserUpdateProcessor(256))
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, overall_time_period=1))
+        .connection_pool_size(256)
+        .pool_timeout(30)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     application.add_handler(
-        MessageHandler(filters.ALL, logging_middleware),
+        TypeHandler(Update, logging_middleware),
         group=-1  
     )
 
@@ -634,14 +962,11 @@ def main():
         fallbacks=[CommandHandler('cancel', cancel)],
     )
     
-    application.add_handler(CommandHandler('start', start))
-    application.add_handler(CommandHandler('help', help_command))
     application.add_handler(profile_conv)
-    application.add_handler(CommandHandler('log_water', log_water))
     application.add_handler(food_conv)
-    application.add_handler(CommandHandler('log_workout', log_workout_start))
-    application.add_handler(CommandHandler('check_progress', check_progress))
-    application.add_handler(CommandHandler('show_graphs', show_graphs))
+    application.add_handler(
+        MessageHandler(filters.UpdateType.MESSAGE & filters.COMMAND, dispatch_command)
+    )
     
     logger.info("bot started")
     application.run_polling(allowed_updates=Update.ALL_TYPES)